@@ -7,7 +7,6 @@ import asyncio
 import math
 import time
 import logging
-from collections import namedtuple
 from typing import Iterable, NamedTuple
 
 import chess
@@ -31,18 +30,36 @@ def loc_to_pos(location: int, rev: bool = False) -> str:
 
 SquareAndPiece = NamedTuple('SquareAndPiece', [('square', chess.Square), ('piece', chess.Piece)])
 
+# piece for every possible nibble value, None for empty (or unknown) squares
+NIBBLE_TO_PIECE = tuple(None if convertDict.get(i, ' ') == ' ' else chess.Piece.from_symbol(convertDict[i])
+                        for i in range(16))
+# same as NIBBLE_TO_PIECE but as expanded fen symbols, '1' for empty squares
+NIBBLE_TO_SYMBOL = tuple(piece.symbol() if piece else '1' for piece in NIBBLE_TO_PIECE)
+
+# LED byte index and bit for every square name, rank 8 is the first byte and file a the highest bit
+POS_TO_BYTE_BIT = {f + r: (8 - int(r), 1 << (7 - (ord(f) - ord('a')))) for f in 'abcdefgh' for r in '12345678'}
+
+# expands the empty square counts of a fen into one '1' per empty square
+FEN_DIGIT_EXPAND = str.maketrans({str(n): '1' * n for n in range(2, 9)})
+
+# translation tables from a byte of the board state to its left (low) and right (high) nibble
+LOW_NIBBLE = bytes(b & 0xf for b in range(256))
+HIGH_NIBBLE = bytes(b >> 4 for b in range(256))
+# every byte with its bits reversed, mirrors the files of one rank of a bitboard like chess.flip_horizontal
+BIT_REVERSE = bytes(int(f'{b:08b}'[::-1], 2) for b in range(256))
+
+
+def board_state_as_nibbles(board_state: bytearray) -> bytearray:
+    """Splits the 32 bytes of board_state into 64 nibbles, nibble i belongs to square 63 - i."""
+    board_state = bytes(board_state)  # no copy for the usual bytes board state
+    nibbles = bytearray(64)
+    nibbles[0::2] = board_state.translate(LOW_NIBBLE)
+    nibbles[1::2] = board_state.translate(HIGH_NIBBLE)
+    return nibbles
 
 
 def board_state_as_square_and_piece(board_state: bytearray) -> Iterable[SquareAndPiece]:
-    s_q = namedtuple("SquareAndPiece", "square, piece")
-    for i in range(32):
-        pair = board_state[i]
-        left = pair & 0xf
-        right = pair >> 4
-        str_left = convertDict[left]
-        yield s_q(63 - i * 2, chess.Piece.from_symbol(str_left) if str_left != ' ' else None)
-        str_right = convertDict[right]
-        yield s_q(63 - (i * 2 + 1), chess.Piece.from_symbol(str_right) if str_right != ' ' else None)
+    return map(SquareAndPiece, range(63, -1, -1), map(NIBBLE_TO_PIECE.__getitem__, board_state_as_nibbles(board_state)))
 
 
 class ChessnutAir:
@@ -51,15 +68,20 @@ class ChessnutAir:
     It discovers the first device with a name that matches the names in DEVICE_LIST.
     """
 
+    # squares of the (left, right) nibble of each byte, 63-i since we get the data backwards
+    SQUARES = tuple((63 - i * 2, 63 - (i * 2 + 1)) for i in range(32))
+
     def __init__(self) -> None:
         self.deviceNameList = DEVICE_LIST  # valid device name list
         self._device = self._advertisement_data = self._connection = None
         self.is_connected = False
-        self.board_state = bytearray(32)
-        self._old_data = bytearray(32)
+        self.board_state = bytes(32)
+        self._old_data = bytes(32)
         self._led_command = bytearray([0x0A, 0x08])
         self._board_changed = False
         self.cur_fen = " "
+        self._fen_cache_key = None
+        self._fen_cache_val = None
         self.to_blink = chess.SquareSet()
         self.to_light = chess.SquareSet()
         self.tick = False
@@ -67,6 +89,7 @@ class ChessnutAir:
         self.charge_percent = 0
         self.last_change = 0
         self.bt_running = True
+        self._piece_events = self._piece_event_task = None
 
     async def blink_tick(self, sleep_time: float = 0.0) -> None:
         self.tick = not self.tick
@@ -146,17 +169,18 @@ class ChessnutAir:
             return
         is_square_set = isinstance(list_of_pos, chess.SquareSet)
         if is_square_set:
-            arr = chess.flip_horizontal(int(list_of_pos)).to_bytes(8, byteorder='big')
+            arr = int(list_of_pos).to_bytes(8, byteorder='big').translate(BIT_REVERSE)
         else:
-            conv_letter = {"a": 128, "b": 64, "c": 32, "d": 16, "e": 8, "f": 4, "g": 2, "h": 1}
-            conv_number = {"1": 7, "2": 6, "3": 5, "4": 4, "5": 3, "6": 2, "7": 1, "8": 0}
-            arr = bytearray([0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+            arr = bytearray(8)
             if list_of_pos is None:
                 return
             for pos in list_of_pos:
-                arr[conv_number[pos[1]]] |= conv_letter[pos[0]]
+                i, bit = POS_TO_BYTE_BIT[pos]
+                arr[i] |= bit
         try:
-            await self._connection.write_gatt_char(constants.BtCharacteristics.write, self._led_command + arr)
+            # write without response, LED frames don't need to wait for a round trip
+            await self._connection.write_gatt_char(constants.BtCharacteristics.write, self._led_command + arr,
+                                                   response=False)
         except Exception as e:
             if isinstance(e, BleakError):
                 raise
@@ -172,39 +196,60 @@ class ChessnutAir:
         waits for sleep_time and repeats until no more frames
         """
         for frame in list_of_frames:
-            await self.change_leds(chess.SquareSet(map(lambda s: chess.parse_square(s), frame)))
-            await asyncio.sleep(sleep_time)
+            # sleep while the frame is sent instead of after it
+            await asyncio.gather(self.change_leds(chess.SquareSet(map(lambda s: chess.parse_square(s), frame))),
+                                 asyncio.sleep(sleep_time))
 
     async def _board_handler(self, _: BleakGATTCharacteristic, data: bytearray) -> None:
         if data[:2] != constants.BtResponses.head_buffer:
             log.warning(f'Other data recieved: {data}')
 
-        rdata = data[2:34]
+        rdata = bytes(data[2:34])
         time_stamp = int.from_bytes(data[34:], byteorder="little")
         if rdata != self._old_data:
+            if self._piece_events is None:
+                self._start_piece_events()
             delay_slot = []
-            async def send_message(loc, old, new):
+            def send_message(loc, old, new):
                 if old != new:
                     if new == 0:
-                        await self.piece_up(loc, chess.Piece.from_symbol(convertDict[old]))
+                        self._piece_events.put_nowait((self.piece_up, loc, NIBBLE_TO_PIECE[old]))
                     else:
-                        delay_slot.append((loc, chess.Piece.from_symbol(convertDict[new])))
+                        delay_slot.append((loc, NIBBLE_TO_PIECE[new]))
             self.last_change = time_stamp
             self._board_changed = True
             self.board_state = rdata
             od = self._old_data
             self._old_data = rdata
-            for i in range(32):
-                if rdata[i] != od[i]:
-                    cur_left = rdata[i] & 0xf
-                    old_left = od[i] & 0xf
-                    cur_right = rdata[i] >> 4
-                    old_right = od[i] >> 4
-                    await send_message(63 - i * 2, old_left, cur_left)  # 63-i since we get the data backwards
-                    await send_message(63 - (i * 2 + 1), old_right, cur_right)
+            # xor both states as one big int so only the changed bytes have to be looked at
+            changed = int.from_bytes(rdata, byteorder='little') ^ int.from_bytes(od, byteorder='little')
+            while changed:
+                i = ((changed & -changed).bit_length() - 1) // 8  # index of lowest changed byte
+                changed &= ~(0xff << (i * 8))
+                cur, old = rdata[i], od[i]
+                left_square, right_square = self.SQUARES[i]
+                send_message(left_square, old & 0xf, cur & 0xf)
+                send_message(right_square, old >> 4, cur >> 4)
             for loc, p in delay_slot:
-                await self.piece_down(loc, p)
+                self._piece_events.put_nowait((self.piece_down, loc, p))
 
+    def _start_piece_events(self) -> None:
+        self._piece_events = asyncio.Queue()
+        self._piece_event_task = asyncio.create_task(self._piece_event_consumer())
+
+    async def _piece_event_consumer(self) -> None:
+        """
+        Calls piece_up() and piece_down() for the events queued by _board_handler one after another,
+        so the notification handler returns right away and can't be blocked by slow game logic.
+        """
+        while True:
+            callback, square, piece = await self._piece_events.get()
+            try:
+                await callback(square, piece)
+            except Exception as e:
+                log.error(f"Error while handling piece event! Exception: {type(e)} {e}")
+            finally:
+                self._piece_events.task_done()
 
     async def _misc_handler(self, _: BleakGATTCharacteristic, data: bytearray) -> None:
         if data == constants.BtResponses.heartbeat_code:
@@ -273,6 +318,9 @@ class ChessnutAir:
             await self._connection.stop_notify(constants.BtCharacteristics.read_board_data)
             await self._connection.stop_notify(constants.BtCharacteristics.read_misc_data)
             await self._connection.stop_notify(constants.BtCharacteristics.read_otb_data)
+        if self._piece_event_task:
+            self._piece_event_task.cancel()
+            self._piece_events = self._piece_event_task = None
 
     async def request_battery_status(self) -> None:
         if self.is_connected:
@@ -283,25 +331,31 @@ class ChessnutAir:
                 log.error(f"Error while requesting Battery! Exception: {type(e)} {e}")
 
     def board_state_as_fen(self, board_state=None) -> str:
-        fen = ''
-        empty_count = 0
-
-        def handle_empties():
-            nonlocal empty_count, fen
-            if empty_count > 0:
-                fen += str(empty_count)
-                empty_count = 0
-
-        for square, piece in board_state_as_square_and_piece(board_state if board_state else self.board_state):
-            if piece:
-                handle_empties()
-                fen += piece.symbol()
-            else:
-                empty_count += 1
-            if square in chess.SquareSet(chess.BB_FILE_A):
-                handle_empties()
-                fen += '/'
-        self.cur_fen = '/'.join(map(lambda row: ''.join(reversed(row)), fen[:-1].split('/')))
+        board_state = board_state if board_state else self.board_state
+        key = bytes(board_state)
+        if key == self._fen_cache_key:
+            self.cur_fen = self._fen_cache_val
+            return self.cur_fen
+        fen = []
+        for row in range(8):  # rank 8 first, it is stored first on the board too
+            empty_count = 0
+            if row:
+                fen.append('/')
+            for file in range(8):
+                pair = board_state[row * 4 + (7 - file) // 2]
+                piece = NIBBLE_TO_PIECE[pair & 0xf if file & 1 else pair >> 4]
+                if piece:
+                    if empty_count:
+                        fen.append(str(empty_count))
+                        empty_count = 0
+                    fen.append(piece.symbol())
+                else:
+                    empty_count += 1
+            if empty_count:
+                fen.append(str(empty_count))
+        self.cur_fen = ''.join(fen)
+        self._fen_cache_key = key
+        self._fen_cache_val = self.cur_fen
         return self.cur_fen
 
     def compare_board_state_to_fen(self, target_fen):
@@ -318,13 +372,16 @@ class ChessnutAir:
             convert "r1bqkbnr/pppppppp/2n5/8/2P5/8/PP1PPPPP/RNBQKBNR w KQkq c6 0 2"
             to "r1bqkbnr/pppppppp/11n11111/11111111/11P11111/11111111/PP1PPPPP/RNBQKBNR"
             """
-            fen = fen.split()[0]
-            return ''.join(map(lambda p: "1" * int(p) if p.isdigit() and p != '1' else p, fen))
+            return fen.split(None, 1)[0].translate(FEN_DIGIT_EXPAND)
 
+        if self.board_state_as_fen() == target_fen.split(None, 1)[0]:
+            return []
         target = ''.join(reversed(convert_fen(target_fen).split("/")))
         differences = []
-        for square, piece in board_state_as_square_and_piece(self.board_state):
-            new_piece = chess.Piece.from_symbol(target[square]) if target[square] != '1' else None
-            if piece != new_piece:
-                differences.append((piece, square, new_piece))
+        for i, pair in enumerate(self.board_state):
+            for square, nibble in zip(self.SQUARES[i], (pair & 0xf, pair >> 4)):
+                symbol = target[square]
+                if symbol != NIBBLE_TO_SYMBOL[nibble]:
+                    new_piece = chess.Piece.from_symbol(symbol) if symbol != '1' else None
+                    differences.append((NIBBLE_TO_PIECE[nibble], square, new_piece))
         return differences
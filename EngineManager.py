@@ -1,6 +1,6 @@
 import hashlib
 import os.path
-import pathlib
+import pickle
 import re
 import chess
 import chess.engine
@@ -14,6 +14,11 @@ import asyncio
 import logging
 log = logging.getLogger("ChessnutPy")
 
+# bump when the layout of the eco_dict cache changes, so old caches get rebuilt
+ECO_CACHE_VERSION = 2
+# key of the opening names in the nodes of EngineManager._eco_trie, can't collide with a uci move
+COMMENT_KEY = 'comment'
+
 
 class EngineManager:
 
@@ -27,16 +32,20 @@ class EngineManager:
         # chess.engine.SimpleEngine.popen_uci(suggestion_engine_path)
         self.engine_suggest = None
         self.suggestion_book = options.suggestion_book_dir
+        self._book_readers = {}  # book path -> open chess.polyglot.MemoryMappedReader
         self.limit = chess.engine.Limit(time=options.engine_time, nodes=options.engine_nodes,
                                         depth=options.engine_depth)
         self.limit_sug = chess.engine.Limit(time=options.sug_time, nodes=options.sug_nodes,
                                             depth=options.sug_depth)
         self.engines_running = False
-        self.eco_pgn = None  # chess.pgn.BoardGame()
+        self._eco_trie = None  # uci move -> child node, COMMENT_KEY -> openings reaching this node
         self.eco_dict = {}
         # self.init_scid_eco_file()
         self.eco_file = options.eco_file
         self.dict_cache_file = 'eco_dict.cache'
+        self._eco_cache = {}  # entry md5 -> (entry md5, zobrist hash, code, name, uci moves), filled by read_eco_dict
+        self._eco_entries = []  # same tuples as in _eco_cache in eco file order
+        self._eco_file_hash = None
         self.last_suggestion = None
         self.last_ai_move = None
         self.username = options.username
@@ -119,61 +128,68 @@ class EngineManager:
         except asyncio.exceptions.CancelledError:
             log.info("suggestion was canceled")
 
+    def _get_book_reader(self, book):
+        """open book on first use and keep the reader around until quit_chess_engines"""
+        try:
+            return self._book_readers[book]
+        except KeyError:
+            reader = self._book_readers[book] = chess.polyglot.open_reader(book)
+            return reader
+
+    def close_books(self):
+        for reader in self._book_readers.values():
+            reader.close()
+        self._book_readers = {}
+
     def get_book_move(self, board, book, weighted=True):
-        with chess.polyglot.open_reader(book) as reader:
-            try:
-                move = reader.weighted_choice(
-                    board) if weighted else reader.choice(board)
-                log.info(move)
-                return move.move
-            except IndexError:
-                return None
+        reader = self._get_book_reader(book)
+        try:
+            move = reader.weighted_choice(
+                board) if weighted else reader.choice(board)
+            log.info(move)
+            return move.move
+        except IndexError:
+            return None
 
     def get_book_moves(self, board):
-        with chess.polyglot.open_reader(self.suggestion_book) as reader:
-            try:
-                # we cant return the interator directly since we close the file after returning
-                return [e for e in reader.find_all(board)]
-            except IndexError:
-                return None
+        reader = self._get_book_reader(self.suggestion_book)
+        try:
+            return list(reader.find_all(board))
+        except IndexError:
+            return None
 
     def print_openings(self, board):
-        if self.eco_pgn:
-            cur_var = self.eco_pgn
-            for n in board.move_stack:
-                if cur_var.has_variation(n):
-                    cur_var = cur_var.variation(n)
-                else:
-                    cur_var = None
+        if self._eco_trie:
+            node = self._eco_trie
+            for move in board.move_stack:
+                node = node.get(move.uci())
+                if node is None:
                     break
-            if cur_var:
-                return '\n'.join(reversed(cur_var.comment.split('\n')))
+            if node is not None:
+                return '\n'.join(reversed(node[COMMENT_KEY].split('\n')))
             else:
                 return f'no openers found: {" ".join(map(lambda m: m.uci(), board.move_stack))}'
         else:
-            fen = board.board_fen()
-            try:
-                return self.eco_dict[fen]
-            except KeyError:
-                return None
+            return self.eco_dict.get(chess.polyglot.zobrist_hash(board))
 
     async def quit_chess_engines(self):
         if self.engines_running:
             await self.engine.quit()
             await self.engine_suggest.quit()
             self.engines_running = False
+        self.close_books()
 
     def write_to_pgn(self, board):
         # check if we have a full movestack
-        temp_board = board.board.copy()
-        for i in range(len(temp_board.move_stack)):
-            temp_board.pop()
-        if temp_board.fen() != chess.Board().fen():
+        if board.board.root().fen() != chess.STARTING_FEN:
+            return
+        if len(board.board.move_stack) == 0:
+            log.info("No PGN Written")
             return
         cur_time = time.localtime()
         day_str = f'{cur_time.tm_year}.{cur_time.tm_mon:02}.{cur_time.tm_mday:02}'
         time_str = f"{day_str}_{cur_time.tm_hour}_{cur_time.tm_min}"
-        game = chess.pgn.Game()
+        game = chess.pgn.Game.from_board(board.board)
         # noinspection SpellCheckingInspection
         game.headers["Event"] = "VakantOS"
         game.headers["Date"] = day_str
@@ -192,22 +208,17 @@ class EngineManager:
             else:
                 res = '1/2-1/2'
         game.headers["Result"] = res
-        if len(board.board.move_stack) == 0:
-            log.info("No PGN Written")
-            return
-        move = board.board.move_stack.pop(0)
-        node = game.add_main_variation(move)
-        for move in board.board.move_stack:
-            node = node.add_main_variation(move)
-        print(game, file=open(f"{time_str}.pgn", 'w'))
+        with open(f"{time_str}.pgn", 'w') as pgn_file:
+            game.accept(chess.pgn.FileExporter(pgn_file))
         log.info("PGN written")
 
     def init_eco_file(self, ):
         """
         read the eco file with format:
         'E94    1. d4 Nf6 2. c4 g6 3. Nc3 Bg7 4. e4 d6 5. Nf3 O-O 6. Be2 e5 7. O-O "King's Indian, Classical Variation"'
-        and fill self.eco_pgn with the moves and names
+        and fill self._eco_trie with the moves and names
         """
+        self._eco_trie = {COMMENT_KEY: ''}
         with open(self.eco_file, "rt") as eco_file:
             eco_line = eco_file.readline().strip()
             while eco_line:
@@ -221,88 +232,125 @@ class EngineManager:
                 b = chess.Board()
                 id_string = f'({name}, {code})\n'
                 uci_moves = list(map(lambda m: b.push_san(m.strip()), moves))
-                self.move_list_to_pgn(id_string, uci_moves)
+                self.move_list_to_trie(id_string, uci_moves)
                 eco_line = eco_file.readline()
 
     def init_scid_eco_both(self):
-        self.eco_pgn = chess.pgn.Game()
+        self._eco_trie = {COMMENT_KEY: ''}
         with open(self.eco_file, "rt") as eco_file:
             for name, code, uci_moves, board in read_scid_eco_entries(eco_file):
-                self.move_list_to_pgn(f'({name}, {code})\n', uci_moves)
-                fen = board.board_fen()
+                self.move_list_to_trie(f'({name}, {code})\n', uci_moves)
+                key = chess.polyglot.zobrist_hash(board)
                 try:
-                    self.eco_dict[fen].append((name, code))
+                    self.eco_dict[key].append((name, code))
                 except KeyError:
-                    self.eco_dict[fen] = [(name, code)]
+                    self.eco_dict[key] = [(name, code)]
 
     def init_scid_eco_file(self):
         """
         read the eco file with format:
         'A03 "Bird: 1...d5 2.Nf3 Nf6 3.g3 g6: 5.d3"
             1.f4 d5 2.Nf3 Nf6 3.g3 g6 4.Bg2 Bg7 5.d3 *' -> ["1", "f4 d5 2", "Nf3 Nf6 3", ...]
-        and fill self.eco_pgn with the moves and names
+        and fill self._eco_trie with the moves and names
         """
-        self.eco_pgn = chess.pgn.Game()
+        self._eco_trie = {COMMENT_KEY: ''}
         with open(self.eco_file, "rt") as eco_file:
-            for name, code, uci_moves in read_scid_eco_entries(eco_file):
-                self.move_list_to_pgn(f'({name}, {code})\n', uci_moves)
+            for name, code, uci_moves, _ in read_scid_eco_entries(eco_file):
+                self.move_list_to_trie(f'({name}, {code})\n', uci_moves)
 
     def init_scid_eco_dict(self):
+        """
+        fill self.eco_dict from the eco file, entries which didn't change since the cache was written
+        are taken from self._eco_cache so only new or edited entries have to be parsed again
+        """
+        self.eco_dict = {}
+        self._eco_entries = []
         with open(self.eco_file, 'r') as eco_file:
-            duplicates = 0
-            for name, code, moves, board in read_scid_eco_entries(eco_file):
-                fen = board.board_fen()
+            duplicates = reparsed = 0
+            prefix_cache = {}
+            for eco_entry in read_scid_eco_blocks(eco_file):
+                entry_md5 = hashlib.md5(eco_entry.encode()).hexdigest()
+                entry = self._eco_cache.get(entry_md5)
+                if entry is None:
+                    name, code, moves, board = parse_scid_eco_entry(eco_entry, prefix_cache)
+                    entry = (entry_md5, chess.polyglot.zobrist_hash(board), code, name,
+                             ' '.join(m.uci() for m in moves))
+                    reparsed += 1
+                self._eco_entries.append(entry)
+                _, key, code, name, _ = entry
                 try:
-                    self.eco_dict[fen].append((name, code))
+                    self.eco_dict[key].append((name, code))
                     duplicates += 1
                 except KeyError:
-                    self.eco_dict[fen] = [(name, code)]
-            log.info(f'duplicates: {duplicates}')
+                    self.eco_dict[key] = [(name, code)]
+            log.info(f'duplicates: {duplicates}, reparsed: {reparsed}')
 
-    def move_list_to_pgn(self, id_string, uci_moves):
-        cur_var = self.eco_pgn
+    def move_list_to_trie(self, id_string, uci_moves):
+        cur_node = self._eco_trie
         if len(uci_moves) < 1:
-            cur_var.comment += id_string
+            cur_node[COMMENT_KEY] += id_string
         for i, cur_move in enumerate(uci_moves):
-            if cur_var.has_variation(cur_move):
-                if id_string not in cur_var.variation(cur_move).comment:
-                    # if this is the last move: put id on the front of the string
-                    if len(uci_moves) == i + 1:
-                        cur_var.variation(cur_move).comment = \
-                            f'{id_string}\n{cur_var.variation(cur_move).comment}'
-                    else:
-                        cur_var.variation(cur_move).comment += id_string
-
-            else:
-                cur_var.add_variation(cur_move).comment = id_string
-            cur_var = cur_var.variation(cur_move)
+            next_node = cur_node.get(cur_move.uci())
+            if next_node is None:
+                next_node = cur_node[cur_move.uci()] = {COMMENT_KEY: id_string}
+            elif id_string not in next_node[COMMENT_KEY]:
+                # if this is the last move: put id on the front of the string
+                if len(uci_moves) == i + 1:
+                    next_node[COMMENT_KEY] = f'{id_string}\n{next_node[COMMENT_KEY]}'
+                else:
+                    next_node[COMMENT_KEY] += id_string
+            cur_node = next_node
+
+    def _eco_hash(self):
+        """md5 of the eco file, streamed in chunks and only computed once"""
+        if self._eco_file_hash is None:
+            md5 = hashlib.md5()
+            with open(self.eco_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    md5.update(chunk)
+            self._eco_file_hash = md5.hexdigest()
+        return self._eco_file_hash
 
     def write_eco_dict(self):
-        with open("eco_dict.cache", 'w') as f:
-            h = hashlib.md5(pathlib.Path(
-                self.eco_file).read_bytes()).hexdigest()
-            print(h, file=f)
-            for key in self.eco_dict:
-                val = self.eco_dict[key]
-                print(f'{key}|{val[0][1]}|{val[0][0]}', file=f)
+        """
+        pickle (ECO_CACHE_VERSION, md5 of the eco file, per entry cache, eco_dict) to the cache file,
+        the per entry cache holds (entry_md5, zobrist hash, code, name, uci_moves) for every eco entry
+        """
+        with open(self.dict_cache_file, 'wb') as f:
+            h = self._eco_hash()
+            pickle.dump((ECO_CACHE_VERSION, h, self._eco_entries, self.eco_dict), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
         log.info('wrote eco_dict')
 
     def read_eco_dict(self):
-        with open(self.dict_cache_file, 'r') as f:
-            h = str(hashlib.md5(pathlib.Path(
-                self.eco_file).read_bytes()).hexdigest())
-            nh = f.readline().strip()
-            if h != nh:
-                log.info(f'hashes didnt match:\n{h}\n{nh}')
+        """
+        read the cache written by write_eco_dict,
+        if the eco file changed since then only the per entry cache is kept and False is returned
+        """
+        with open(self.dict_cache_file, 'rb') as f:
+            h = self._eco_hash()
+            try:
+                version, nh, entries, eco_dict = pickle.load(f)
+            except Exception as e:
+                log.info(f'eco_dict cache has an unknown format: {type(e)} {e}')
                 return False
-            for line in f:
-                fen, name, code = line.strip(' \n').split('|')
-                self.eco_dict[fen] = [(name, code)]
+        if version != ECO_CACHE_VERSION:
+            log.info(f'eco_dict cache version {version} is outdated')
+            return False
+        self._eco_cache = {entry[0]: entry for entry in entries}
+        if h != nh:
+            log.info(f'hashes didnt match:\n{h}\n{nh}')
+            return False
+        self._eco_entries = entries
+        self.eco_dict = eco_dict
         log.info('read eco_dict')
         return True
 
 
-def read_scid_eco_entries(eco_file):
+def read_scid_eco_blocks(eco_file):
+    """
+    yield the raw text of every entry in a scid eco file, entries can span multiple lines and end with '*'
+    """
     count = 0
 
     def read_line():
@@ -318,28 +366,60 @@ def read_scid_eco_entries(eco_file):
             eco_line = read_line()
         while len(eco_line) == 0 or eco_line[-1] != '*':
             eco_line += ' ' + read_line()
-        split = eco_line.split('"')
-        code = split[0].strip()
-        name = split[1] if len(split) > 1 else ""
-        rest = split[2]
-        split = rest.split('.')
-        turns = map(lambda m: m[:-2].split(),
-                    filter(lambda m: len(m.strip()) > 1, split))
-        moves = []
-        for t in turns:
-            m1 = t[0]
-            moves.append(m1)
-            if len(t) > 1:
-                m2 = t[1]
-                moves.append(m2)
-        b = chess.Board()
-        uci_moves = list(map(lambda m: b.push_san(m.strip()), moves))
-        yield name, code, uci_moves, b
+        yield eco_line
         count += 1
         eco_line = eco_file.readline()
     log.info(count)
 
 
+def parse_scid_eco_entry(eco_line, prefix_cache=None):
+    """
+    parse an entry like:
+    'A03 "Bird: 1...d5 2.Nf3 Nf6 3.g3 g6: 5.d3"  1.f4 d5 2.Nf3 Nf6 3.g3 g6 4.Bg2 Bg7 5.d3 *'
+    and return name, code, uci_moves and the board after all moves (without move stack)
+    prefix_cache maps tuples of san moves to (board, uci_moves) and is shared between entries,
+    so the moves of openings that start the same only have to be parsed once
+    """
+    split = eco_line.split('"')
+    code = split[0].strip()
+    name = split[1] if len(split) > 1 else ""
+    rest = split[2]
+    split = rest.split('.')
+    turns = map(lambda m: m[:-2].split(),
+                filter(lambda m: len(m.strip()) > 1, split))
+    moves = []
+    for t in turns:
+        m1 = t[0]
+        moves.append(m1)
+        if len(t) > 1:
+            m2 = t[1]
+            moves.append(m2)
+    if prefix_cache is None:
+        prefix_cache = {}
+    moves = tuple(m.strip() for m in moves)
+    # find the longest prefix of moves we already parsed
+    known = len(moves)
+    while known > 0 and moves[:known] not in prefix_cache:
+        known -= 1
+    if known > 0:
+        b, uci_moves = prefix_cache[moves[:known]]
+        b = b.copy(stack=False)
+        uci_moves = list(uci_moves)
+    else:
+        b = chess.Board()
+        uci_moves = []
+    for i in range(known, len(moves)):
+        uci_moves.append(b.push_san(moves[i]))
+        prefix_cache[moves[:i + 1]] = (b.copy(stack=False), tuple(uci_moves))
+    return name, code, uci_moves, b
+
+
+def read_scid_eco_entries(eco_file):
+    prefix_cache = {}
+    for eco_line in read_scid_eco_blocks(eco_file):
+        yield parse_scid_eco_entry(eco_line, prefix_cache)
+
+
 def read_uci_file(file_path):
     """Read a .uci file in the style of picochess to get uci setting presets for engines"""
     contents = ""